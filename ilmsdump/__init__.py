@@ -10,9 +10,11 @@ import hashlib
 import io
 import itertools
 import json
+import operator
 import os
 import pathlib
 import pickle
+import random
 import re
 import shlex
 import shutil
@@ -20,22 +22,84 @@ import signal
 import sys
 import time
 import types
-from typing import AsyncGenerator, Awaitable, Iterable, Iterator, List, Optional, Union
+from typing import (
+    AsyncGenerator,
+    AsyncIterable,
+    Awaitable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import aiohttp
 import click
+import lxml.etree
 import lxml.html
+import orjson
 import wcwidth
 import yarl
 from PIL import Image
 
 from ilmsdump import captcha
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 DOMAIN = 'lms.nthu.edu.tw'
 LOGIN_URL = 'https://lms.nthu.edu.tw/sys/lib/ajax/login_submit.php'
 LOGIN_STATE_URL = 'http://lms.nthu.edu.tw/home.php'
 COURSE_LIST_URL = 'http://lms.nthu.edu.tw/home.php?f=allcourse'
 
+# maximum number of list pages fetched concurrently
+PAGINATOR_PREFETCH = 8
+# maximum number of courses fetched concurrently
+FOREACH_COURSE_CONCURRENCY = 16
+# requests per second sent to iLMS, and how many may be sent in a burst
+REQUEST_RATE = 30
+REQUEST_BURST = 16
+# response statuses that are retried with backoff
+RETRY_STATUSES = frozenset({400, 429, 500, 502, 503, 504})
+
+_XPATH_LOGIN = lxml.etree.XPath('//*[@id="login"]')
+_XPATH_PROFILE_NAME = lxml.etree.XPath(
+    '//*[@id="profile"]/div[2]/div[1]/text()', smart_strings=False
+)
+_XPATH_COURSE_NAME = lxml.etree.XPath('//div[@class="infoPath"]/a/text()', smart_strings=False)
+_XPATH_COURSE_HINT = lxml.etree.XPath(
+    '//div[@class="infoTable"]//td[2]/span[@class="hint"]/text()', smart_strings=False
+)
+_XPATH_COURSE_IS_ADMIN = lxml.etree.XPath('//div[@id="main"]//a[@href="javascript:editDoc(1)"]')
+_XPATH_ENROLLED_COURSES = lxml.etree.XPath('//td[@class="listTD"]/a')
+_XPATH_OPEN_COURSES = lxml.etree.XPath(
+    '//div[@class="tableBox"]//a[starts-with(@href, "/course/")]'
+)
+_XPATH_PAGE_COMBO_TOTAL = lxml.etree.XPath(
+    '//input[@id="PageCombo"]/following-sibling::text()', smart_strings=False
+)
+_XPATH_PAGER_ITEM_HREFS = lxml.etree.XPath(
+    '//span[@class="page"]/span[@class="item"]/a/@href', smart_strings=False
+)
+_XPATH_PAGER_HREFS = lxml.etree.XPath('//span[@class="page"]//a/@href', smart_strings=False)
+_XPATH_PAGER_NEXT_HREF = lxml.etree.XPath(
+    '//span[@class="page"]//a[text()="Next"]/@href', smart_strings=False
+)
+_XPATH_TABLE_SECOND_ROW_TDS = lxml.etree.XPath('//div[@class="tableBox"]/table/tr[2]/td')
+_XPATH_LIST_ROWS = lxml.etree.XPath('//*[@id="main"]//tr[@class!="header"]')
+_XPATH_ROW_HREF = lxml.etree.XPath('td[1]/a/@href', smart_strings=False)
+_XPATH_ANNOUNCEMENT_TITLE = lxml.etree.XPath('td[2]//a/text()', smart_strings=False)
+_XPATH_MATERIAL_LINKS = lxml.etree.XPath('//*[@id="main"]//tr[@class!="header"]/td[2]/div/a')
+_XPATH_DISCUSSION_ATTACHED = lxml.etree.XPath('.//img[@class="vmiddle"]')
+_XPATH_DISCUSSION_TITLE = lxml.etree.XPath('td[2]//a/span/text()', smart_strings=False)
+_XPATH_HOMEWORK_LINKS = lxml.etree.XPath('//*[@id="main"]//tr[@class!="header"]/td[2]/a[1]')
+
+_COURSE_HINT_RE = re.compile(r'\(\w+, (\w+), \w+, \w+\)')
+_COURSE_HREF_RE = re.compile(r'/course/(\d+)')
+
 
 class LoginFailed(Exception):
     pass
@@ -60,6 +124,9 @@ class DownloadFailed(Exception):
 def as_sync(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        # uvloop.run() is only available since uvloop 0.18
+        if hasattr(uvloop, 'run'):
+            return uvloop.run(func(*args, **kwargs))
         return asyncio.run(func(*args, **kwargs))
 
     return wrapper
@@ -97,6 +164,62 @@ def as_empty_async_generator(func):
     return wrapper
 
 
+def _orjson_dumps(obj) -> str:
+    # aiohttp expects a str
+    return orjson.dumps(obj).decode()
+
+
+async def collect(aiterable: AsyncIterable) -> list:
+    return [item async for item in aiterable]
+
+
+async def cancel_tasks(tasks: Iterable[asyncio.Future]):
+    """
+    Cancel tasks and wait for them, retrieving exceptions of those that already failed
+    """
+    tasks = list(tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class StatusLine:
+    """
+    A line on stderr that is updated in place.
+    Other output can be printed above it within `hidden()`.
+    """
+
+    def __init__(self):
+        self.text = ''
+
+    def update(self, text: str):
+        self._clear()
+        self.text = text
+        print(end=text, file=sys.stderr, flush=True)
+
+    def finish(self):
+        if self.text:
+            print(file=sys.stderr)
+            self.text = ''
+
+    def _clear(self):
+        if self.text:
+            print(end='\r' + ' ' * len(self.text) + '\r', file=sys.stderr, flush=True)
+
+    @contextlib.contextmanager
+    def hidden(self):
+        self._clear()
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            if self.text:
+                print(end=self.text, file=sys.stderr, flush=True)
+
+
+status_line = StatusLine()
+
+
 @contextlib.contextmanager
 def capture_keyboard_interrupt() -> Iterator[asyncio.Event]:
     event = asyncio.Event()
@@ -141,6 +264,45 @@ def qs_get(url: str, key: str) -> str:
         raise KeyError(key, url) from None
 
 
+@functools.lru_cache(maxsize=None)
+def _qs_pattern(key: str) -> re.Pattern:
+    return re.compile(rf'[?&]{re.escape(key)}=([^&#]*)')
+
+
+def qs_get_int(url: str, key: str) -> int:
+    """
+    Like int(qs_get(url, key)), without parsing the whole URL
+    """
+    m = _qs_pattern(key).search(url)
+    if m is None:
+        raise KeyError(key, url)
+    return int(m.group(1))
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` acquisitions per second, in bursts of up to `burst`
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
 class Client:
     def __init__(self, data_dir):
         self.bytes_downloaded = 0
@@ -148,7 +310,20 @@ class Client:
         trace_config = aiohttp.TraceConfig()
         trace_config.on_response_chunk_received.append(self.session_on_response_chunk_received)
 
+        # all requests go to a single host, so keep connections around for reuse
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=16,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+        )
+
+        self.rate_limiter = RateLimiter(REQUEST_RATE, REQUEST_BURST)
+
         self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': f'ilmsdump aiohttp/{aiohttp.__version__}'},
+            json_serialize=_orjson_dumps,
             raise_for_status=True,
             trace_configs=[trace_config],
             timeout=aiohttp.ClientTimeout(total=80),
@@ -157,7 +332,11 @@ class Client:
         self.data_dir = pathlib.Path(data_dir).absolute()
         os.makedirs(self.data_dir, exist_ok=True)
 
-        self.cred_path = os.path.join(self.data_dir, 'credentials.txt')
+        self.cred_path = self.data_dir / 'credentials.txt'
+
+        # shared by the parses that are done in one go; we never look up elements by ID
+        self.html_parser = lxml.html.HTMLParser(collect_ids=False)
+        self._authenticating: Optional[asyncio.Future] = None
 
     async def __aenter__(self):
         return self
@@ -175,6 +354,7 @@ class Client:
         retries = 3
         sleep_duration = 5
         while True:
+            await self.rate_limiter.acquire()
             try:
                 async with self.session.request(*args, **kwargs) as response:
                     yield response
@@ -182,7 +362,7 @@ class Client:
             except aiohttp.ClientResponseError as exc:
                 if not retries:
                     raise
-                if exc.status != 400:
+                if exc.status not in RETRY_STATUSES:
                     raise
                 print(file=sys.stderr)
                 print(f'Exception occurred: {exc}', file=sys.stderr)
@@ -190,36 +370,41 @@ class Client:
                     f'Sleeping for {sleep_duration}s; remaining retries: {retries}',
                     file=sys.stderr,
                 )
-                await asyncio.sleep(sleep_duration)
+                # jitter so that concurrent requests do not retry in lockstep
+                await asyncio.sleep(sleep_duration + random.random())
                 sleep_duration *= 4
                 retries -= 1
 
     async def ensure_authenticated(self, prompt: bool):
+        """
+        Login with the saved credentials, or interactively if prompt is true.
+        Only the first call logs in; later calls wait for its result.
+        """
+        if self._authenticating is None:
+            self._authenticating = asyncio.ensure_future(self._authenticate(prompt))
+        await self._authenticating
+
+    async def _authenticate(self, prompt: bool):
         try:
-            cred_file = open(self.cred_path)
+            phpsessid = self.cred_path.read_text().strip()
         except FileNotFoundError:
             if prompt:
                 await self.interactive_login()
-                with open(self.cred_path, 'w') as file:
-                    print(
-                        self.session.cookie_jar.filter_cookies(yarl.URL(LOGIN_STATE_URL))[
-                            'PHPSESSID'
-                        ].value,
-                        file=file,
-                    )
+                phpsessid = self.session.cookie_jar.filter_cookies(yarl.URL(LOGIN_STATE_URL))[
+                    'PHPSESSID'
+                ].value
+                self.cred_path.write_text(phpsessid + '\n')
                 self.log('Saved credentials to', self.cred_path)
         else:
-            with cred_file:
-                self.log('Using existing credentials in', self.cred_path)
-                phpsessid = cred_file.read().strip()
-                await self.login_with_phpsessid(phpsessid)
+            self.log('Using existing credentials in', self.cred_path)
+            await self.login_with_phpsessid(phpsessid)
 
     def clear_credentials(self):
         """
         Clear saved credentials. Returns true if something is actually removed. False otherwise.
         """
         try:
-            os.remove(self.cred_path)
+            self.cred_path.unlink()
         except FileNotFoundError:
             self.log('No credentials saved in', self.cred_path)
             return False
@@ -254,8 +439,8 @@ class Client:
             },
         )
         async with login as response:
-            response.raise_for_status()
             json_body = await response.json(
+                loads=orjson.loads,
                 content_type=None,  # to bypass application/json check
             )
         json_ret = json_body['ret']
@@ -274,13 +459,13 @@ class Client:
         self.log('Logged in as', name)
 
     async def get_login_state(self):
-        async with self.session.get(LOGIN_STATE_URL) as response:
-            html = lxml.html.fromstring(await response.read())
+        async with self.request('GET', LOGIN_STATE_URL) as response:
+            html = await self.read_html(response)
 
-            if not html.xpath('//*[@id="login"]'):
+            if not _XPATH_LOGIN(html):
                 return None
 
-            name_node = html.xpath('//*[@id="profile"]/div[2]/div[1]/text()')
+            name_node = _XPATH_PROFILE_NAME(html)
             assert name_node
             return ''.join(name_node).strip()
 
@@ -292,8 +477,21 @@ class Client:
     ) -> None:
         self.bytes_downloaded += len(params.chunk)
 
+    async def read_html(self, response: aiohttp.ClientResponse) -> lxml.html.HtmlElement:
+        """
+        Parse the response body as HTML while it is being received
+        """
+        # a parser being fed cannot be shared with concurrent requests
+        parser = lxml.html.HTMLParser(encoding=response.charset, collect_ids=False)
+        async for chunk in response.content.iter_chunked(0x10000):
+            if not _workaround_client_response_content_is_traced:
+                self.bytes_downloaded += len(chunk)
+            parser.feed(chunk)
+        return parser.close()
+
     async def get_course(self, course_id: int) -> 'Course':
-        async with self.session.get(
+        async with self.request(
+            'GET',
             'http://lms.nthu.edu.tw/course.php',
             params={
                 'courseID': course_id,
@@ -310,16 +508,16 @@ class Client:
                     f"the course probably doesn't exist: course_id={course_id}"
                 )
 
-            html = lxml.html.fromstring(body)
+            html = lxml.html.fromstring(body, parser=self.html_parser)
 
-            (name,) = html.xpath('//div[@class="infoPath"]/a/text()')
+            (name,) = _XPATH_COURSE_NAME(html)
 
-            (hint,) = html.xpath('//div[@class="infoTable"]//td[2]/span[@class="hint"]/text()')
-            m = re.match(r'\(\w+, (\w+), \w+, \w+\)', hint)
+            (hint,) = _XPATH_COURSE_HINT(html)
+            m = _COURSE_HINT_RE.match(hint)
             assert m is not None, hint
             serial = m.group(1)
 
-            if html.xpath('//div[@id="main"]//a[@href="javascript:editDoc(1)"]'):
+            if _XPATH_COURSE_IS_ADMIN(html):
                 is_admin = True
             else:
                 is_admin = False
@@ -334,15 +532,15 @@ class Client:
             return course
 
     async def get_enrolled_courses(self) -> AsyncGenerator['Course', None]:
-        async with self.session.get(COURSE_LIST_URL) as response:
+        async with self.request('GET', COURSE_LIST_URL) as response:
             body = await response.read()
             if b'\xe6\xac\x8a\xe9\x99\x90\xe4\xb8\x8d\xe8\xb6\xb3!' in body:
                 # '權限不足!'
                 raise UserError('Cannot get enrolled courses. Are you logged in?')
-            html = lxml.html.fromstring(body)
+            html = lxml.html.fromstring(body, parser=self.html_parser)
 
-            for a in html.xpath('//td[@class="listTD"]/a'):
-                bs = a.xpath('b')
+            for a in _XPATH_ENROLLED_COURSES(html):
+                bs = a.findall('b')
                 if bs:
                     is_admin = True
                     (tag,) = bs
@@ -353,7 +551,7 @@ class Client:
                 name = tag.text
                 serial = a.getparent().getparent()[0].text
 
-                m = re.match(r'/course/(\d+)', a.attrib['href'])
+                m = _COURSE_HREF_RE.match(a.attrib['href'])
                 if m is None:
                     raise CannotUnderstand('course URL', a.attrib['href'])
                 yield Course(
@@ -367,8 +565,9 @@ class Client:
         page = 1
         total_pages = 1
         while page <= total_pages:
-            print(end=f'\rIndexing open courses: page {page} of {total_pages}', file=sys.stderr)
-            async with self.session.get(
+            status_line.update(f'Indexing open courses: page {page} of {total_pages}')
+            async with self.request(
+                'GET',
                 'http://lms.nthu.edu.tw/course/index.php',
                 params={
                     'nav': 'course',
@@ -377,16 +576,16 @@ class Client:
                     'page': page,
                 },
             ) as response:
-                html = lxml.html.fromstring(await response.read())
+                html = await self.read_html(response)
 
-            total_pages_strs = html.xpath('//input[@id="PageCombo"]/following-sibling::text()')
+            total_pages_strs = _XPATH_PAGE_COMBO_TOTAL(html)
             if total_pages_strs:
                 total_pages = int(total_pages_strs[0].rpartition('/')[2])
             else:
-                for href in html.xpath('//span[@class="page"]/span[@class="item"]/a/@href'):
-                    total_pages = max(total_pages, int(qs_get(href, 'page')))
+                for href in _XPATH_PAGER_ITEM_HREFS(html):
+                    total_pages = max(total_pages, qs_get_int(href, 'page'))
 
-            for a in html.xpath('//div[@class="tableBox"]//a[starts-with(@href, "/course/")]'):
+            for a in _XPATH_OPEN_COURSES(html):
                 id_ = int(os.path.basename(a.attrib['href']))
                 title = a.text
                 serial_div = a.getparent().getprevious()[0]
@@ -401,7 +600,7 @@ class Client:
                 )
 
             page += 1
-        print()
+        status_line.finish()
 
     def get_dir_for(self, item: Downloadable) -> pathlib.Path:
         d = self.data_dir / item.__class__.__name__.lower() / str(item.id)
@@ -411,6 +610,8 @@ class Client:
 
 class Downloadable:
 
+    __slots__ = ()
+
     _CLASSES: List[str] = []
     id: int
 
@@ -421,6 +622,15 @@ class Downloadable:
     def as_id_string(self):
         return f'{self.__class__.__name__}-{self.id}'
 
+    def __setstate__(self, state):
+        # Instances pickled before __slots__ were added carry a __dict__ state;
+        # slotted instances carry a (None, slots) tuple
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = {**(dict_state or {}), **(slots_state or {})}
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
     def get_meta(self) -> dict:
         return {
             field.name: flatten_attribute(getattr(self, field.name))
@@ -600,7 +810,7 @@ def html_get_main(html: lxml.html.HtmlElement) -> lxml.html.HtmlElement:
 
 
 def table_is_empty(html: lxml.html.HtmlElement) -> bool:
-    second_row_tds = html.xpath('//div[@class="tableBox"]/table/tr[2]/td')
+    second_row_tds = _XPATH_TABLE_SECOND_ROW_TDS(html)
     if len(second_row_tds) == 1:
         # 目前尚無資料 or No Data
         assert second_row_tds[0].text in ('目前尚無資料', 'No Data')
@@ -613,8 +823,7 @@ def get_attachments(parent: Downloadable, element: lxml.html.HtmlElement) -> Ite
     for a in element.xpath('.//a[starts-with(@href, "/sys/read_attach.php")]'):
         if a.text is None or not a.text.strip():
             continue
-        url = yarl.URL(a.attrib['href'])
-        id_ = int(url.query['id'])
+        id_ = qs_get_int(a.attrib['href'], 'id')
         if id_ in ids:
             continue
         ids.add(id_)
@@ -630,6 +839,8 @@ def get_attachments(parent: Downloadable, element: lxml.html.HtmlElement) -> Ite
 class Course(Downloadable):
     """歷年課程檔案"""
 
+    __slots__ = ('id', 'serial', 'is_admin', 'name')
+
     id: int
     serial: str  # 科號
     is_admin: bool
@@ -646,8 +857,14 @@ class Course(Downloadable):
             self.get_scores(client),
             self.get_grouplists(client),
         ]
-        for generator in generators:
-            async for item in generator:
+        # the listings are independent; fetch them concurrently
+        tasks = [asyncio.ensure_future(collect(generator)) for generator in generators]
+        try:
+            listings = await asyncio.gather(*tasks)
+        finally:
+            await cancel_tasks(tasks)
+        for items in listings:
+            for item in items:
                 yield item
 
         async with client.request(
@@ -658,7 +875,7 @@ class Course(Downloadable):
                 'f': 'syllabus',
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
 
         if html.xpath('//input[@id="loginAccount"]'):
             raise UserError('Must login')
@@ -666,46 +883,65 @@ class Course(Downloadable):
         with (client.get_dir_for(self) / 'index.html').open('wb') as file:
             file.write(lxml.html.tostring(main))
 
+    async def _fetch_page(self, client, url: yarl.URL):
+        async with client.request('GET', url) as response:
+            return await client.read_html(response)
+
     async def _item_paginator(self, client, f, page=1):
-        for page in itertools.count(page):
-            async with client.request(
-                'GET',
-                'http://lms.nthu.edu.tw/course.php',
-                params={
-                    'courseID': self.id,
-                    'f': f,
-                    'page': page,
-                },
-            ) as response:
-                html = lxml.html.fromstring(await response.read())
+        """
+        Yield the pages of the item list `f` in order.
+
+        Pages known to exist from the pager links are fetched ahead of time,
+        at most PAGINATOR_PREFETCH pages at once.
+        """
+        list_url = yarl.URL('http://lms.nthu.edu.tw/course.php').with_query(
+            courseID=self.id,
+            f=f,
+        )
+        fetching = {}
+        last_known_page = page
+        try:
+            for page in itertools.count(page):
+                for p in range(page, min(last_known_page + 1, page + PAGINATOR_PREFETCH)):
+                    if p not in fetching:
+                        fetching[p] = asyncio.ensure_future(
+                            self._fetch_page(client, list_url.update_query(page=p))
+                        )
+                html = await fetching.pop(page)
 
                 if table_is_empty(html):
                     break
 
+                for href in _XPATH_PAGER_HREFS(html):
+                    with contextlib.suppress(KeyError, ValueError):
+                        last_known_page = max(last_known_page, qs_get_int(href, 'page'))
+
                 yield html
 
-                next_hrefs = html.xpath('//span[@class="page"]//a[text()="Next"]/@href')
+                next_hrefs = _XPATH_PAGER_NEXT_HREF(html)
                 if not next_hrefs:
                     break
-                next_page = int(qs_get(next_hrefs[0], 'page'))
+                next_page = qs_get_int(next_hrefs[0], 'page')
                 assert page + 1 == next_page
+        finally:
+            await cancel_tasks(fetching.values())
 
     async def get_announcements(self, client) -> AsyncGenerator['Announcement', None]:
         async for html in self._item_paginator(client, 'news'):
-            for tr in html.xpath('//*[@id="main"]//tr[@class!="header"]'):
-                (href,) = tr.xpath('td[1]/a/@href')
-                (title,) = tr.xpath('td[2]//a/text()')
+            for tr in _XPATH_LIST_ROWS(html):
+                (href,) = _XPATH_ROW_HREF(tr)
+                (title,) = _XPATH_ANNOUNCEMENT_TITLE(tr)
                 yield Announcement(
-                    id=int(qs_get(href, 'newsID')),
+                    id=qs_get_int(href, 'newsID'),
                     title=title,
                     course=self,
                 )
 
     async def get_materials(self, client) -> AsyncGenerator['Material', None]:
         async for html in self._item_paginator(client, 'doclist'):
-            for a in html.xpath('//*[@id="main"]//tr[@class!="header"]/td[2]/div/a'):
+            for a in _XPATH_MATERIAL_LINKS(html):
                 yield Material(
-                    id=int(qs_get(a.attrib['href'], 'cid')),
+                    id=qs_get_int(a.attrib['href'], 'cid'),
                     title=a.text,
                     type=a.getparent().attrib['class'],
                     course=self,
@@ -713,24 +949,24 @@ class Course(Downloadable):
 
     async def get_discussions(self, client) -> AsyncGenerator['Discussion', None]:
         async for html in self._item_paginator(client, 'forumlist'):
-            for tr in html.xpath('//*[@id="main"]//tr[@class!="header"]'):
-                if tr.xpath('.//img[@class="vmiddle"]'):
+            for tr in _XPATH_LIST_ROWS(html):
+                if _XPATH_DISCUSSION_ATTACHED(tr):
                     # XXX: belongs to a homework, material
                     # don't know if it is accessible
                     continue
-                (href,) = tr.xpath('td[1]/a/@href')
-                (title,) = tr.xpath('td[2]//a/span/text()')
+                (href,) = _XPATH_ROW_HREF(tr)
+                (title,) = _XPATH_DISCUSSION_TITLE(tr)
                 yield Discussion(
-                    id=int(qs_get(href, 'tid')),
+                    id=qs_get_int(href, 'tid'),
                     title=title,
                     course=self,
                 )
 
     async def get_homeworks(self, client) -> AsyncGenerator['Homework', None]:
         async for html in self._item_paginator(client, 'hwlist'):
-            for a in html.xpath('//*[@id="main"]//tr[@class!="header"]/td[2]/a[1]'):
+            for a in _XPATH_HOMEWORK_LINKS(html):
                 yield Homework(
-                    id=int(qs_get(a.attrib['href'], 'hw')),
+                    id=qs_get_int(a.attrib['href'], 'hw'),
                     title=a.text,
                     course=self,
                 )
@@ -744,7 +980,7 @@ class Course(Downloadable):
                 'courseID': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
             if not html.xpath(
                 '//div[@id="main"]//input[@type="button" and @onclick="history.back()"]'
             ):
@@ -759,7 +995,7 @@ class Course(Downloadable):
                 'courseID': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
             if not table_is_empty(html):
                 yield GroupList(course=self)
 
@@ -768,6 +1004,8 @@ class Course(Downloadable):
 class Announcement(Downloadable):
     """課程活動(公告)"""
 
+    __slots__ = ('id', 'title', 'course')
+
     id: int
     title: str
     course: Course
@@ -783,14 +1021,15 @@ class Announcement(Downloadable):
                 'type': 'n',
             },
         ) as response:
-            body_json = await response.json(content_type=None)
+            body_json = await response.json(loads=orjson.loads, content_type=None)
 
         if body_json['news']['note'] == 'NA' and body_json['news']['poster'] == '':
             raise Unavailable(body_json)
 
         attachment_raw_div = body_json['news']['attach']
         if attachment_raw_div is not None:
-            for attachment in get_attachments(self, lxml.html.fromstring(attachment_raw_div)):
+            attachment_div = lxml.html.fromstring(attachment_raw_div, parser=client.html_parser)
+            for attachment in get_attachments(self, attachment_div):
                 yield attachment
 
         with (client.get_dir_for(self) / 'index.json').open('w') as file:
@@ -801,6 +1040,8 @@ class Announcement(Downloadable):
 class Material(Downloadable):
     """上課教材"""
 
+    __slots__ = ('id', 'title', 'type', 'course')
+
     id: int
     title: str
     type: str  # "Econtent" or "Epowercam"
@@ -818,7 +1059,7 @@ class Material(Downloadable):
                 'cid': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
         main = html_get_main(html)
 
         for attachment in get_attachments(self, main):
@@ -844,7 +1085,7 @@ class Material(Downloadable):
                 'area_size': '724x3',
             },
         ) as response:
-            body_json = await response.json(content_type=None)
+            body_json = await response.json(loads=orjson.loads, content_type=None)
         if body_json['ret']['status'] != 'true':
             raise CannotUnderstand(f'Video not found: {self}, {body_json}')
         if body_json['ret']['player_width'] is None:
@@ -852,7 +1093,7 @@ class Material(Downloadable):
             # {"ret":{"status":"true","id":"2475544","embed":"...",
             # "player_width":null,"player_height":null}}
             return None
-        html = lxml.html.fromstring(body_json['ret']['embed'])
+        html = lxml.html.fromstring(body_json['ret']['embed'], parser=client.html_parser)
         (src,) = html.xpath('//video/@src')
         return Video(id=self.id, url=base_url.join(yarl.URL(src)))
 
@@ -861,6 +1102,8 @@ class Material(Downloadable):
 class Discussion(Downloadable):
     """討論區"""
 
+    __slots__ = ('id', 'title', 'course')
+
     id: int
     title: str
     course: Course
@@ -875,7 +1118,7 @@ class Discussion(Downloadable):
                 'id': self.id,
             },
         ) as response:
-            body_json = await response.json(content_type=None)
+            body_json = await response.json(loads=orjson.loads, content_type=None)
             if body_json['posts']['status'] != 'true':
                 raise CannotUnderstand(body_json)
 
@@ -895,6 +1138,8 @@ class Discussion(Downloadable):
 class Homework(Downloadable):
     """作業"""
 
+    __slots__ = ('id', 'title', 'course')
+
     id: int
     title: str
     course: Course
@@ -912,7 +1157,7 @@ class Homework(Downloadable):
                 'hw': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
         main = html_get_main(html)
         for to_remove in main.xpath('.//span[@class="toolWrapper"]'):
             to_remove.getparent().remove(to_remove)
@@ -933,7 +1178,7 @@ class Homework(Downloadable):
                 'hw': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
 
         main = html_get_main(html)
 
@@ -959,7 +1204,7 @@ class Homework(Downloadable):
             if not a_s:
                 continue
             (a,) = a_s
-            id_ = int(qs_get(a.attrib['href'], 'cid'))
+            id_ = qs_get_int(a.attrib['href'], 'cid')
             title = a.text
 
             comments = tr[ititle].xpath('div/img[@src="/sys/res/icon/hw_comment.png"]/@title')
@@ -1007,7 +1252,7 @@ class SubmittedHomework(Downloadable):
                 'cid': self.id,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
 
         main = html_get_main(html)
 
@@ -1042,7 +1287,7 @@ class SinglePageDownloadable(Downloadable):
                 **self.extra_params,
             },
         ) as response:
-            html = lxml.html.fromstring(await response.read())
+            html = await client.read_html(response)
             main = html_get_main(html)
 
             with (client.get_dir_for(self) / 'index.html').open('wb') as file:
@@ -1112,43 +1357,114 @@ class Video(Downloadable):
                     file.write(chunk)
 
 
-def generate_table(items):
+_wcswidth = functools.lru_cache(maxsize=4096)(wcwidth.wcswidth)
+
+
+def _cell_width(cell: str) -> int:
+    if cell.isascii():
+        return len(cell)
+    return _wcswidth(cell)
+
+
+def _format_row(row: List[str], row_widths: List[int], widths: List[int]) -> str:
+    # the last column is not padded
+    padded = [
+        cell + ' ' * (width - cell_width)
+        for cell, cell_width, width in zip(row[:-1], row_widths, widths)
+    ]
+    padded.append(row[-1])
+    return '  '.join(padded)
+
+
+def _table_row(item, getters: List[operator.attrgetter]) -> List[str]:
+    return [str(getter(item)) for getter in getters]
+
+
+def _table_lines(items) -> Tuple[List[str], List[operator.attrgetter], List[int]]:
+    """
+    Returns the lines of the table, the getters of its fields and its column widths
+    """
     fields = [field.name for field in dataclasses.fields(items[0])]
+    getters = [operator.attrgetter(field) for field in fields]
     rows = [fields]
-    rows.extend([str(getattr(item, field)) for field in fields] for item in items)
-    widths = [max(map(wcwidth.wcswidth, col)) for col in zip(*rows)]
-    for i, row in enumerate(rows):
-        for j, (width, cell) in enumerate(zip(widths, row)):
-            if j:
-                yield '  '
-            yield cell
-            if j + 1 < len(row):
-                yield ' ' * (width - wcwidth.wcswidth(cell))
-        yield '\n'
-        if i == 0:
-            for j, width in enumerate(widths):
-                if j:
-                    yield '  '
-                yield '-' * width
-            yield '\n'
+    rows.extend(_table_row(item, getters) for item in items)
+    cell_widths = [[_cell_width(cell) for cell in row] for row in rows]
+    widths = [max(col) for col in zip(*cell_widths)]
+    lines = [_format_row(row, row_widths, widths) for row, row_widths in zip(rows, cell_widths)]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return lines, getters, widths
+
+
+def format_table(items) -> str:
+    lines, _, _ = _table_lines(items)
+    return '\n'.join(lines)
 
 
 def print_table(items):
-    print(end=''.join(generate_table(items)))
+    print(format_table(items))
+
+
+async def print_table_streaming(items: AsyncIterable, buffer_size: int = 16) -> list:
+    """
+    Print a table of items as they arrive, then return them as a list.
+
+    Column widths are decided by the first `buffer_size` items.
+    A later cell that does not fit overflows its column and is never cut.
+    """
+    result = []
+    getters: List[operator.attrgetter] = []
+    widths: List[int] = []
+    async for item in items:
+        result.append(item)
+        if not widths:
+            if len(result) == buffer_size:
+                lines, getters, widths = _table_lines(result)
+                with status_line.hidden():
+                    print('\n'.join(lines))
+        else:
+            row = _table_row(item, getters)
+            row_widths = [_cell_width(cell) for cell in row]
+            with status_line.hidden():
+                print(_format_row(row, row_widths, widths))
+    if not widths and result:
+        with status_line.hidden():
+            print_table(result)
+    return result
 
 
 async def foreach_course(
     client: Client, course_ids: List[Union[str, int]]
 ) -> AsyncGenerator[Course, None]:
+    """
+    Yield courses in the order of `course_ids`.
+    Courses given by their ID are fetched concurrently, at most
+    FOREACH_COURSE_CONCURRENCY at once.
+    """
+    semaphore = asyncio.BoundedSemaphore(FOREACH_COURSE_CONCURRENCY)
+
+    async def get_course(course_id: int) -> Course:
+        async with semaphore:
+            return await client.get_course(course_id)
+
+    tasks: List[Optional[asyncio.Future]] = []
     for course_id in course_ids:
-        if course_id == 'enrolled':
-            async for course in client.get_enrolled_courses():
-                yield course
-        elif course_id == 'open':
-            async for course in client.get_open_courses():
-                yield course
+        if course_id in {'enrolled', 'open'}:
+            tasks.append(None)
         else:
-            yield await client.get_course(int(course_id))
+            tasks.append(asyncio.ensure_future(get_course(int(course_id))))
+
+    try:
+        for course_id, task in zip(course_ids, tasks):
+            if course_id == 'enrolled':
+                async for course in client.get_enrolled_courses():
+                    yield course
+            elif course_id == 'open':
+                async for course in client.get_open_courses():
+                    yield course
+            else:
+                yield await task
+    finally:
+        await cancel_tasks(task for task in tasks if task is not None)
 
 
 def validate_course_id(ctx, param, value: str):
@@ -1156,7 +1472,8 @@ def validate_course_id(ctx, param, value: str):
     for course_id in value:
         if course_id in {'enrolled', 'open'}:
             result.append(course_id)
-        elif not course_id.isdigit():
+        elif not (course_id.isascii() and course_id.isdigit()):
+            # isdigit() alone accepts digits that int() rejects, such as '²'
             raise click.BadParameter('must be a number or the string "enrolled"')
         else:
             result.append(int(course_id))
@@ -1255,9 +1572,7 @@ async def main(
                 targets.extend(resmue_data['items'])
                 ignores.update(resmue_data['ignore'])
         if course_ids:
-            courses = [course async for course in foreach_course(client, course_ids)]
-            if courses:
-                print(end=''.join(generate_table(courses)))
+            courses = await print_table_streaming(foreach_course(client, course_ids))
             targets.extend(courses)
 
         if targets:
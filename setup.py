@@ -37,12 +37,16 @@ setup(
         'aiohttp',
         'yarl',
         'lxml',
+        'orjson',
         'click',
         'wcwidth',
         'pillow',
         'aiohttp-jinja2',
     ],
     extras_require={
+        'uvloop': [
+            'uvloop>=0.18; sys_platform != "win32"',
+        ],
         'dev': [
             'pytest',
             'pytest-asyncio',
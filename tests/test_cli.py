@@ -21,6 +21,14 @@ def test_nothing_to_do(tempdir):
     assert result.stderr == 'Nothing to do\n'
 
 
+def test_invalid_course_id(tempdir):
+    runner = click.testing.CliRunner(mix_stderr=False)
+    for course_id in ['abc', '²']:
+        result = runner.invoke(ilmsdump.main, ['--output-dir', tempdir, course_id])
+        assert result.exit_code == 2
+        assert 'must be a number' in result.stderr
+
+
 def test_logout(tempdir):
     cred_file = os.path.join(tempdir, 'credentials.txt')
     open(cred_file, 'w').close()
@@ -1,3 +1,7 @@
+import asyncio
+import contextlib
+
+import lxml.html
 import pytest
 
 import ilmsdump
@@ -88,3 +92,64 @@ async def test_download(client: ilmsdump.Client):
     assert data.HOMEWORK_198377 in items
     assert data.HOMEWORK_200355 in items
     assert data.GROUPLIST_40596 in items
+
+
+def fake_list_page(page, last_page):
+    next_link = f'<a href="?f=news&page={page + 1}">Next</a>' if page < last_page else ''
+    pages = ''.join(
+        f'<span class="item"><a href="?f=news&page={p}">{p}</a></span>'
+        for p in range(1, last_page + 1)
+    )
+    return f'''
+        <div class="tableBox"><table>
+            <tr class="header"><td>#</td><td>title</td></tr>
+            <tr><td>{page}</td><td>page {page}</td></tr>
+        </table></div>
+        <span class="page">{pages}{next_link}</span>
+    '''
+
+
+class FakeListClient:
+    def __init__(self, last_page, delays, fail=()):
+        self.last_page = last_page
+        self.delays = delays
+        self.fail = fail
+        self.requested = []
+        self.cancelled = []
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url):
+        page = int(url.query['page'])
+        self.requested.append(page)
+        try:
+            await asyncio.sleep(self.delays[page])
+        except asyncio.CancelledError:
+            self.cancelled.append(page)
+            raise
+        if page in self.fail:
+            raise ilmsdump.Unavailable(page)
+        yield page
+
+    async def read_html(self, page):
+        return lxml.html.fromstring(fake_list_page(page, self.last_page))
+
+
+@pytest.mark.asyncio
+async def test_item_paginator_order():
+    # later pages arrive first
+    client = FakeListClient(last_page=4, delays={1: 0, 2: 0.03, 3: 0.02, 4: 0.01})
+    pages = [html async for html in data.COURSE_74._item_paginator(client, 'news')]
+
+    assert [html.xpath('string(//tr[2]/td[1])') for html in pages] == ['1', '2', '3', '4']
+    assert sorted(client.requested) == [1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_item_paginator_failure():
+    client = FakeListClient(last_page=4, delays={1: 0, 2: 0, 3: 10, 4: 10}, fail={2})
+    with pytest.raises(ilmsdump.Unavailable):
+        async for html in data.COURSE_74._item_paginator(client, 'news'):
+            pass
+
+    # the prefetched pages are cancelled and awaited before the error propagates
+    assert sorted(client.cancelled) == [3, 4]
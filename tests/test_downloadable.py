@@ -1,3 +1,5 @@
+import pickle
+
 from tests import data
 
 
@@ -12,3 +14,21 @@ def test_get_meta():
         'name': '平行程式Parallel Programming',
         'is_admin': False,
     }
+
+
+# data.COURSE_74 pickled with protocol 4 by a version without __slots__
+COURSE_74_DICT_STATE_PICKLE = (
+    b'\x80\x04\x95h\x00\x00\x00\x00\x00\x00\x00\x8c\x08ilmsdump\x94\x8c\x06Course\x94\x93'
+    b'\x94)\x81\x94}\x94(\x8c\x02id\x94KJ\x8c\x06serial\x94\x8c\x040001\x94\x8c\x08is_admin'
+    b'\x94\x89\x8c\x04name\x94\x8c\x1ciLMS\xe5\xb9\xb3\xe5\x8f\xb0\xe7\xb7\x9a\xe4\xb8\x8a'
+    b'\xe5\xae\xa2\xe6\x9c\x8d\xe5\xb0\x88\xe5\x8d\x80\x94ub.'
+)
+
+
+def test_unpickle_dict_state():
+    assert pickle.loads(COURSE_74_DICT_STATE_PICKLE) == data.COURSE_74
+
+
+def test_pickle_roundtrip():
+    items = [data.COURSE_74, data.ANNOUNCEMENT_2008652]
+    assert pickle.loads(pickle.dumps(items)) == items
@@ -1,5 +1,7 @@
+import asyncio
 import os
 import signal
+import time
 
 import lxml.html
 import pytest
@@ -15,6 +17,14 @@ def test_qs_get():
         ilmsdump.qs_get('http://example.com', 'a')
 
 
+def test_qs_get_int():
+    assert ilmsdump.qs_get_int('/course.php?f=news&newsID=2008652', 'newsID') == 2008652
+    assert ilmsdump.qs_get_int('?f=doclist&page=2#top', 'page') == 2
+    with pytest.raises(KeyError):
+        ilmsdump.qs_get_int('/course.php?courseID=40596&f=news', 'page')
+    assert ilmsdump.qs_get_int('/course.php?courseID=40596&f=news', 'courseID') == 40596
+
+
 def test_flatten_attribute():
     assert ilmsdump.flatten_attribute(3) == 3
     assert ilmsdump.flatten_attribute(yarl.URL('http://example.org')) == 'http://example.org'
@@ -42,22 +52,88 @@ def test_get_attachments():
     assert list(ilmsdump.get_attachments(data.HOMEWORK_32460, html)) == []
 
 
-def test_generate_table():
-    table = ''.join(
-        ilmsdump.generate_table(
-            [data.COURSE_74, data.COURSE_1808, data.COURSE_359],
-        )
+def test_format_table():
+    table = ilmsdump.format_table(
+        [data.COURSE_74, data.COURSE_1808, data.COURSE_359],
     )
     expected = '''\
 id    serial           is_admin  name
 ----  ---------------  --------  -----------------------------------
 74    0001             False     iLMS平台線上客服專區
 1808  09810BMES525100  False     藥物控制釋放Drug Controlled Release
-359   09810CL492400    False     敦煌學Dunhuang Studies
-'''
+359   09810CL492400    False     敦煌學Dunhuang Studies'''
     assert expected == table
 
 
+@pytest.mark.asyncio
+async def test_print_table_streaming(capsys):
+    courses = [data.COURSE_74, data.COURSE_359, data.COURSE_1808, data.COURSE_399]
+
+    async def agen():
+        for course in courses:
+            yield course
+
+    assert await ilmsdump.print_table_streaming(agen(), buffer_size=2) == courses
+    # 1808 overflows the widths of the buffered rows; later rows stay aligned
+    expected = '''\
+id   serial         is_admin  name
+---  -------------  --------  ----------------------
+74   0001           False     iLMS平台線上客服專區
+359  09810CL492400  False     敦煌學Dunhuang Studies
+1808  09810BMES525100  False     藥物控制釋放Drug Controlled Release
+399  09810CS140107  False     資訊系統應用Computer Systems & Applications
+'''
+    assert capsys.readouterr().out == expected
+
+    assert await ilmsdump.print_table_streaming(agen()) == courses
+    assert capsys.readouterr().out == ilmsdump.format_table(courses) + '\n'
+
+
+def test_status_line(capsys):
+    status_line = ilmsdump.StatusLine()
+    status_line.update('page 1')
+    with status_line.hidden():
+        print('row')
+    status_line.update('page 2')
+    status_line.finish()
+
+    captured = capsys.readouterr()
+    assert captured.out == 'row\n'
+    assert captured.err == 'page 1\r      \rpage 1\r      \rpage 2\n'
+
+
+class FakeCourseClient:
+    def __init__(self, delays, fail=()):
+        self.delays = delays
+        self.fail = fail
+        self.cancelled = []
+
+    async def get_course(self, course_id):
+        try:
+            await asyncio.sleep(self.delays[course_id])
+        except asyncio.CancelledError:
+            self.cancelled.append(course_id)
+            raise
+        if course_id in self.fail:
+            raise ilmsdump.UserError(course_id)
+        return course_id
+
+
+@pytest.mark.asyncio
+async def test_foreach_course_order():
+    # later courses finish first, but are yielded in order
+    client = FakeCourseClient({1: 0.03, 2: 0.02, 3: 0.01})
+    assert await ilmsdump.collect(ilmsdump.foreach_course(client, [1, 2, 3])) == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_foreach_course_failure():
+    client = FakeCourseClient({1: 0, 2: 0.01, 3: 10}, fail={2})
+    with pytest.raises(ilmsdump.UserError):
+        await ilmsdump.collect(ilmsdump.foreach_course(client, [1, 2, 3]))
+    assert client.cancelled == [3]
+
+
 @pytest.mark.asyncio
 async def test_empty_async_generator():
     called = 0
@@ -71,6 +147,40 @@ async def test_empty_async_generator():
     assert called == 1
 
 
+@pytest.mark.asyncio
+async def test_collect():
+    async def agen():
+        yield 1
+        yield 2
+
+    assert await ilmsdump.collect(agen()) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_cancel_tasks():
+    async def fail():
+        raise ValueError
+
+    failed = asyncio.ensure_future(fail())
+    pending = asyncio.ensure_future(asyncio.sleep(10))
+    await asyncio.sleep(0)
+    assert failed.done()
+
+    await ilmsdump.cancel_tasks([failed, pending])
+    assert pending.cancelled()
+    assert isinstance(failed.exception(), ValueError)
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    limiter = ilmsdump.RateLimiter(rate=100, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        await limiter.acquire()
+    # the burst is immediate, the other two wait for 10ms each
+    assert 0.015 <= time.monotonic() - start < 0.5
+
+
 @pytest.mark.skip()
 @pytest.mark.asyncio
 async def test_capture_keyboard_interrupt():